@@ -1,28 +1,22 @@
 import sys, csv
+from itertools import islice
 
 infile = sys.argv[1]
+batch_size = 5000
 
-with open(infile, "r") as f_in:
+with open(infile, "r", newline="") as f_in:
     reader = csv.reader(f_in)
-    header = reader.next()
-    count = 0
+    header = next(reader)
     outnum = 1
-    batch = []
-    for row in reader:
-        batch.append(row)
-        count += 1
-        if count == 5000:
-            outfile = "%s-batched-%s.csv" % (infile[:-4], str(outnum).rjust(4, "0"))
-            with open(outfile, "wb") as f_out:
-                writer = csv.writer(f_out)
-                writer.writerow(header)
-                writer.writerows(batch)
-            batch = []
-            count = 0
-            outnum += 1
-
-outfile = "%s-batched-%s.csv" % (infile[:-4], str(outnum).rjust(4, "0"))
-with open(outfile, "wb") as f_out:
-    writer = csv.writer(f_out)
-    writer.writerow(header)
-    writer.writerows(batch)
+    while True:
+        # islice pulls the next batch straight off the reader - no per-row
+        # counter and nothing held in memory beyond the current batch
+        batch = list(islice(reader, batch_size))
+        if not batch:
+            break
+        outfile = "%s-batched-%s.csv" % (infile[:-4], str(outnum).rjust(4, "0"))
+        with open(outfile, "w", newline="") as f_out:
+            writer = csv.writer(f_out)
+            writer.writerow(header)
+            writer.writerows(batch)
+        outnum += 1
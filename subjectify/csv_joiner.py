@@ -1,20 +1,16 @@
-import sys, csv
+import sys, shutil
 
 inf = sys.argv[1]
 num = int(sys.argv[2])
 outf = sys.argv[3]
 
-head = False
-with open(outf, "wb") as out:
-    fho = csv.writer(out)
-    for x in xrange(1,num+1):
-        fn = "%s-%s.csv"%(inf,str(x).rjust(4, "0"))
-        print "Reading ", fn
-        with open(fn, 'r') as fh:
-            r = csv.reader(fh)
-            h = r.next()
-            if not head:
-                fho.writerow(h)
-                head = True
-            for row in r:
-                fho.writerow(row)
\ No newline at end of file
+with open(outf, "wb") as f_out:
+    for x in range(1, num + 1):
+        fn = "%s-%s.csv" % (inf, str(x).rjust(4, "0"))
+        print("Reading ", fn)
+        with open(fn, "rb") as f_in:
+            if x != 1:
+                f_in.readline()  # every batch repeats the header - keep only the first
+            # Joining is pure byte concatenation, so copy the raw bytes in 1 MiB
+            # blocks rather than parsing and re-serialising every row
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
@@ -16,87 +16,160 @@ new CSV file.
 Usage: 'subjectify.py infile.csv outfile.csv'
 """
 
-import sys, os, csv, time, argparse  # standard python libs
+import sys, os, csv, time, argparse, sqlite3, threading, re  # standard python libs
 import xml.etree.ElementTree as ET  # standard python libs
+from concurrent.futures import ThreadPoolExecutor  # standard python libs
+from operator import itemgetter  # standard python libs
+from functools import lru_cache  # standard python libs
+from itertools import chain, islice  # standard python libs
 import requests  # external dependency
+from requests.adapters import HTTPAdapter, Retry  # ships with requests
 
 endpoint_url = "http://classify.oclc.org/classify2/Classify"  # OCLC Classify API URL
-base_querystring = "?summary=true&maxRecs=1"
+request_timeout = (3.05, 10)  # (connect, read) timeouts in seconds
+session = requests.Session()  # shared session so repeat queries reuse the same TCP connection
+# Retry transient failures with exponential backoff (0.5s, 1s, 2s...) instead of
+# dropping the row - a blip of packet loss shouldn't cost a record. Retry-After
+# headers from the server are honoured on 429/503.
+retry_policy = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                     respect_retry_after_header=True)
+adapter = HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=retry_policy)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+cache_file = os.environ.get("OCLC_CACHE", "oclc_cache.db")  # on-disk response cache, persists between runs
+cache_max_age = 30 * 86400  # drop cached responses older than 30 days
+cache_lock = threading.Lock()  # sqlite connection is shared between worker threads
+cache = sqlite3.connect(cache_file, check_same_thread=False)
+cache.execute("CREATE TABLE IF NOT EXISTS responses (query TEXT PRIMARY KEY, response BLOB, ts INT)")
+try:
+    cache.execute("ALTER TABLE responses ADD COLUMN ts INT")  # upgrade caches from before expiry existed
+except sqlite3.OperationalError:
+    pass
+cache.execute("DELETE FROM responses WHERE ts IS NULL OR ts < ?", (int(time.time()) - cache_max_age,))
+cache.commit()
 ns = {"classify": "http://classify.oclc.org"}  # xml namespace
+response_re = re.compile(rb'<response[^>]*\bcode="(\d+)"')  # fast path for the response code
+single_codes = frozenset((0, 2))  # response codes meaning a single work record
+# Find paths used against parsed records, hoisted to module level so ElementTree's
+# internal compiled-path cache is hit with the same string objects on every call
+response_path = "classify:response"
+ddc_path = "classify:recommendations/classify:ddc/classify:mostPopular"
+lcc_path = "classify:recommendations/classify:lcc/classify:mostPopular"
+work_path = "classify:works/classify:work[1]"  # ElementTree positions are 1-based
 default_fields = ["isbn", "issn", "author", "title"]  # default csv fields
-verbose = False  # was program started with -v?
+worker_count = 8  # concurrent lookup threads - queries are network bound so overlap nicely
 exact_searches = True  # exact match flag
 searches_seen = {}  # local cache to prevent duplicate queries
-rate_config = {"small_count": 25,  # How often to trigger small delay
-               "small_sleep": 10,  # Length of small delay in seconds
-               "large_count": 250,  # How often to trigger large delay
-               "large_sleep": 120}  # Length of large delay in seconds
+works_seen = {}  # work id -> (ddc, lcc), skips re-fetching a parent work already resolved
+rate_config = {"rate": 2.0, "burst": 10}  # sustained queries per second and burst allowance
+alternate_rate_config = {"rate": 1.0, "burst": 5}  # more conservative limits for the -r flag
 
 
-def load_data(infile, fields="default", skipheader = False):
-    """Read a CSV file and return a list of rows"""
+class TokenBucket:
+    """Thread-safe token bucket used to pace calls to the OCLC API
+
+    Refills at rate tokens per second up to a burst of capacity. acquire() blocks
+    until a token is free, so each HTTP call is paced individually no matter how
+    many worker threads are in flight - replacing the old stop-the-world sleeps
+    every N queries.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+bucket = TokenBucket(rate_config["rate"], rate_config["burst"])
+
+
+def load_data(infile, skipheader=False):
+    """Read a CSV file and yield rows one at a time, each a plain list of strings
+
+    Plain lists rather than DictReader dicts - every row access elsewhere is then
+    a straight list index with no per-field string hashing or dict allocation.
+    A generator rather than a materialised list, so peak memory stays flat no
+    matter how large the export and processing overlaps with reading.
+    """
     # Make sure file exists
     if not os.path.isfile(infile):
         sys.exit("Fatal Error: Input file does not exist!")
     # Attempt to open and read file
     try:
-        with open(infile, "r") as csvfile:
-            if fields == "file":
-                reader = csv.DictReader(csvfile)
-            elif fields == "default":
-                reader = csv.DictReader(csvfile, fieldnames=default_fields)
-            elif fields == "none":
-                reader = csv.reader(csvfile)
-            records_in = []
+        # Big read buffer - the csv module reads line by line, so the default 8 KiB
+        # buffer means a lot of small read syscalls on larger exports
+        with open(infile, "r", buffering=1 << 20, newline="") as csvfile:
+            reader = csv.reader(csvfile)
+            if skipheader:
+                next(reader, None)
             for row in reader:
-                records_in.append(row)
-        if skipheader:
-            records_in = records_in[1:]
+                # Blank lines come back as [] - DictReader used to skip these
+                if row:
+                    yield row
 
-        return records_in
+    except csv.Error as error:
+        # Ending the stream here would look like a successful run over a
+        # shorter file - bail out loudly instead
+        sys.exit("Fatal Error: malformed CSV at line %s of %s: %s"
+                 % (reader.line_num, infile, error))
+    except OSError as error:
+        sys.exit("Fatal Error: could not read %s: %s" % (infile, error))
 
-    except:
-        return None
 
+def open_writer(outfile, fields):
+    """Open the output file and return a (file handle, csv writer, output fields) triple
 
-def write_data(outfile, records, fields):
-    """Write the data in the state object to file and return boolean success indicator"""
-
-    try:
-        with open(outfile, "wb") as csvfile:
-            if fields is not None:
-                # Make sure we have lcc and ddc fields in the list
-                if "lcc" not in fields:
-                    fields.append("lcc")
-                if "ddc" not in fields:
-                    fields.append("ddc")
-
-                writer = csv.DictWriter(csvfile, fieldnames=fields, lineterminator="\n")
-                writer.writeheader()
-            else:
-                writer = csv.writer(csvfile, lineterminator="\n")
-            writer.writerows(records)
-            return True
-    except:
-        return False
+    Rows are written as they are processed rather than collected in memory, so a
+    crashed run keeps everything processed so far and memory stays flat on big files.
+    """
+    csvfile = open(outfile, "w", buffering=1 << 20, newline="")
+    writer = csv.writer(csvfile, lineterminator="\n")
+    if fields is not None:
+        fields = list(fields)
+        # Make sure we have ddc and lcc fields in the list, in the order results
+        # get appended to each row
+        if "ddc" not in fields:
+            fields.append("ddc")
+        if "lcc" not in fields:
+            fields.append("lcc")
+        writer.writerow(fields)
+    return csvfile, writer, fields
 
 
 def get_tree(xmldata):
-    """Takes string or ET and returns an ET"""
-    if type(xmldata) == str:
+    """Takes string/bytes or ET and returns an ET"""
+    if isinstance(xmldata, (str, bytes)):
         try:
             return ET.fromstring(xmldata)
-        except:
+        except ET.ParseError:
             return None
-    elif type(xmldata) == ET.Element:
+    elif isinstance(xmldata, ET.Element):
         return xmldata
     else:
         return None
 
 
+@lru_cache(maxsize=100000)
 def oclc_search(searchtype, data, exact=True):
     """Query OCLC endpoint
 
+    Memoised - repeat queries (duplicate ISBNs, shared work ids) return the
+    previous response bytes without touching the sqlite cache or the network.
+
     Valid searchtype values:
         isbn  (Either ISBN10 or ISBN13 identifier)
         issn  (ISSN-L preferred but p-ISSN or e-ISSN will work)
@@ -113,36 +186,52 @@ def oclc_search(searchtype, data, exact=True):
         None object in event of error making request
     """
 
-    # Basic sanity checks and query forming
+    # Basic sanity checks and query forming - requests handles the percent
+    # encoding, so titles with spaces, quotes or ampersands arrive intact
+    params = {"summary": "true", "maxRecs": "1"}
     if searchtype in ['isbn', 'issn', 'wi', 'title']:
-        if type(data) != str:
+        if not isinstance(data, str):
             return False
         if searchtype == "title" and exact:
             data = "\"" + data + "\""
-        query = "%s=%s" % (searchtype, data)
+        params[searchtype] = data
     elif searchtype == "bib":
-        if type(data) != tuple:
+        if not isinstance(data, tuple):
             return False
         if len(data) != 2:
             return False
-        author, title = data
+        title, author = data
         if exact:
-            query = "author=\"%s\"&title=\"%s\"" % (author, title)
+            params["author"] = "\"%s\"" % author
+            params["title"] = "\"%s\"" % title
         else:
-            query = "author=%s&title=%s" % (author, title)
+            params["author"] = author
+            params["title"] = title
     else:
         # invalid searchtype
         return False
 
-    request_url = endpoint_url + base_querystring + "&" + query
+    # Responses for a given query are effectively immutable, so check the on-disk
+    # cache first - a hit saves the whole network round trip
+    cache_key = "%s:%s:%s" % (searchtype, data, exact)
+    with cache_lock:
+        cached = cache.execute("SELECT response FROM responses WHERE query = ?", (cache_key,)).fetchone()
+    if cached is not None:
+        vprint("Response for %s found in on-disk cache", cache_key)
+        return cached[0]
 
     try:
-        response = requests.get(request_url)
+        bucket.acquire()  # pace outgoing queries - cache hits above don't burn tokens
+        response = session.get(endpoint_url, params=params, timeout=request_timeout)
         if response.status_code == 200:
+            with cache_lock:
+                cache.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                              (cache_key, response.content, int(time.time())))
+                cache.commit()
             return response.content
         else:
             return None
-    except:
+    except requests.RequestException:
         return None
 
 
@@ -159,11 +248,21 @@ def extract_response(record_xml):
     200:  Unexpected error.
     (Source: http://classify.oclc.org/classify2/api_docs/classify.html)
     """
+    if isinstance(record_xml, (str, bytes)):
+        # Fast path - the code attribute sits near the top of the document, so a
+        # precompiled regex avoids building a tree just to read one attribute
+        if isinstance(record_xml, str):
+            record_xml = record_xml.encode()
+        match = response_re.search(record_xml)
+        if match is None:
+            return None
+        return int(match.group(1))
+
     tree = get_tree(record_xml)
     if tree is None:
         return None
 
-    response_code = tree.find("classify:response", ns)
+    response_code = tree.find(response_path, ns)
     if response_code is None:
         # Uh-oh!
         return None
@@ -183,17 +282,15 @@ def extract_ids(record_xml):
     # 0:    Success. Single-work summary response provided.
     # 2:    Success. Single-work detail response provided.
     code = extract_response(tree)
-    if code not in [0, 2]:
+    if code not in single_codes:
         return None
     else:
-        try:
-            ddc = tree.find("classify:recommendations/classify:ddc/classify:mostPopular", ns).attrib["nsfa"]
-        except:
-            ddc = ""
-        try:
-            lcc = tree.find("classify:recommendations/classify:lcc/classify:mostPopular", ns).attrib["nsfa"]
-        except:
-            lcc = ""
+        # A missing recommendation is a normal case, so test for it directly
+        # rather than letting an AttributeError drive the control flow
+        elem = tree.find(ddc_path, ns)
+        ddc = elem.get("nsfa", "") if elem is not None else ""
+        elem = tree.find(lcc_path, ns)
+        lcc = elem.get("nsfa", "") if elem is not None else ""
 
         return ddc, lcc
 
@@ -211,104 +308,133 @@ def resolve_multiple(record_xml):
     if code != 4:
         return None
     else:
-        wi = tree.find("classify:works/classify:work[0]", ns).attrib["wi"]
-        return wi
+        work = tree.find(work_path, ns)
+        return work.get("wi") if work is not None else None
 
 
-def process_row(row, columns, skip_columns = None):
+def make_query_selector(columns):
+    """Build a query selector specialised to the run's column layout
+
+    Which columns exist never changes between rows, so the None checks and the
+    itemgetter are decided once here rather than re-evaluated per row. The
+    returned selector picks the best available search in preference order
+    ISBN > ISSN > author+title > title, returning a (search_type, data) tuple
+    or None if the row has nothing to search on.
+    """
+    highest = max(column for column in columns if column is not None)
+    if None not in columns:
+        # All four columns present - grab the lot in one C-level fetch rather
+        # than four separate index operations in the interpreter loop. Short
+        # rows (DictReader used to pad these with restval) take the slow path
+        fast_getter = itemgetter(*columns)
+
+        def getter(row):
+            if len(row) > highest:
+                return fast_getter(row)
+            return [row[column] if column < len(row) else "" for column in columns]
+    else:
+        def getter(row, columns=tuple(columns)):
+            return [row[column] if column is not None and column < len(row) else ""
+                    for column in columns]
+
+    def selector(row):
+        isbn, issn, author, title = getter(row)
+        if isbn:
+            return "isbn", isbn
+        if issn:
+            return "issn", issn
+        if title:
+            if author:
+                return "bib", (title, author)
+            return "title", title
+        return None
+
+    return selector
+
+
+def apply_result(row, ids, result_columns=None):
+    """Attach a (ddc, lcc) pair to a row - written into the existing ddc/lcc
+    cells when the input file already has them, appended otherwise"""
+    if result_columns and len(row) > max(result_columns):
+        row[result_columns[0]], row[result_columns[1]] = ids
+    else:
+        row.extend(ids)
+    return row
+
+
+def process_row(row, selector, skip_columns=None, result_columns=None):
     """Process a row from the csv file. Main per-record logic. Return row and boolean for whether a query was made"""
 
-    # Does row already have data in any of the skip_columns?
-    if skip_columns:
-        skip = False
-        for column in skip_columns:
-            if row[column] != "":
-                vprint("Data found in column %s, skipping row" % column)
-                skip = True
-        if skip:
-            return row, False
+    # Fast path for resumed runs - a row re-fed from a previous output that
+    # already carries both identifiers has nothing left to look up
+    if result_columns and len(row) > max(result_columns) \
+            and row[result_columns[0]] and row[result_columns[1]]:
+        vprint("Row already has ddc and lcc, skipping")
+        return row, False
+
+    # Does row already have data in any of the skip_columns? any() stops at the
+    # first hit rather than checking every column regardless
+    if skip_columns and any(column < len(row) and row[column] for column in skip_columns):
+        vprint("Data found in a skip column, skipping row")
+        return row, False
 
     # Determine whether we are matching against ISBN/ISSN or bibliographic data
-    # Start from least preferable and check each type, keeping current best in state variable
-    search_type = None
-    data = None
-    if columns[3] and row[columns[3]] != "":  # title
-        if columns[2] and row[columns[2]] != "":  # author
-            search_type = "bib"
-            data = (row[columns[3]], row[columns[2]])
-        else:
-            search_type = "title"
-            data = row[columns[3]]
-    if columns[1] and row[columns[1]] != "":  # issn
-        search_type = "issn"
-        data = row[columns[1]]
-    if columns[0] and row[columns[0]] != "":  # isbn
-        search_type = "isbn"
-        data = row[columns[0]]
-
-    if search_type is None:
+    selected = selector(row)
+    if selected is None:
         return row, False
+    search_type, data = selected
 
     # See if the search has been done before
     if (search_type, data) in searches_seen:
         vprint("Result for this object found in cache")
-        if type(row) == dict:
-            row["ddc"], row["lcc"] = searches_seen[(search_type, data)]["ddc"], searches_seen[(search_type, data)]["lcc"]
-        elif type(row) == list:
-            row.extend(searches_seen[(search_type, data)]["ddc"], searches_seen[(search_type, data)]["lcc"])
+        cached = searches_seen[(search_type, data)]
+        apply_result(row, (cached["ddc"], cached["lcc"]), result_columns)
         return row, False
 
     # Make the first query and check the status
-    vprint("Performing search of type %s with data %s" % (search_type, data))
+    vprint("Performing search of type %s with data %s", search_type, data)
     record = oclc_search(search_type, data, exact_searches)
     status = extract_response(record)
 
     if status is None or status >= 100:
         # Error or no input, return the unaltered input row
-        vprint("Error or no result, adding to cache with key (%s, %s)" %(search_type, data))
+        vprint("Error or no result, adding to cache with key (%s, %s)", search_type, data)
         searches_seen[(search_type, data)] = {"ddc": None, "lcc": None}
         return row, True
-    elif status in [0, 2]:
+    elif status in single_codes:
         vprint("Single record found")
-        # Single work record, go to extraction
-        if type(row) == dict:
-            row["ddc"], row["lcc"] = extract_ids(record)
-            vprint("Adding result dcc: %s lcc: %s to cache with key %s"%(row["ddc"], row["lcc"], (search_type, data)))
-            searches_seen[(search_type, data)] = {"ddc": row["ddc"], "lcc": row["lcc"]}
-        elif type(row) == list:
-            row.extend(extract_ids(record))
-            vprint("Adding result dcc: %s lcc: %s to cache with key %s" % (row[-2], row[-1], (search_type, data)))
-            searches_seen[(search_type, data)] = {"ddc": row[-2], "lcc": row[-1]}
+        # Single work record, parse once and go to extraction
+        ids = extract_ids(get_tree(record)) or ("", "")
+        apply_result(row, ids, result_columns)
+        vprint("Adding result dcc: %s lcc: %s to cache with key %s", ids[0], ids[1], (search_type, data))
+        searches_seen[(search_type, data)] = {"ddc": ids[0], "lcc": ids[1]}
         return row, True
 
     elif status == 4:
         vprint("Multiple records found")
         # Multi-work record, attempt to resolve
-        wi = resolve_multiple(record)
+        wi = resolve_multiple(get_tree(record))
+        ids = None
         if wi:
-            vprint("Parent ID found: %s" % wi)
-            parent_record = oclc_search("wi", wi)
-            parent_status = extract_response(parent_record)
-            if parent_status in [0, 2]:
-                vprint("Parent record found")
-                # Resolved, extract the IDs
-                if type(row) == dict:
-                    row["ddc"], row["lcc"] = extract_ids(parent_record)
-                    vprint("Adding result dcc: %s lcc: %s to cache with key %s" % (row["ddc"], row["lcc"], (search_type, data)))
-                    searches_seen[(search_type, data)] = {"ddc": row["ddc"], "lcc": row["lcc"]}
-                elif type(row) == list:
-                    row.extend(extract_ids(parent_record))
-                    vprint("Adding result dcc: %s lcc: %s to cache with key %s" % (row[-2], row[-1], (search_type, data)))
-                    searches_seen[(search_type, data)] = {"ddc": row[-2], "lcc": row[-1]}
-                return row, True
+            vprint("Parent ID found: %s", wi)
+            if wi in works_seen:
+                vprint("Work %s found in work cache", wi)
+                ids = works_seen[wi]
             else:
-                vprint("Parent record not found, adding nil result to cache with key (%s, %s)" %(search_type, data))
-                searches_seen[(search_type, data)] = {"ddc": None, "lcc": None}
-                return row, True
+                parent_record = oclc_search("wi", wi)
+                parent_status = extract_response(parent_record)
+                if parent_status in single_codes:
+                    vprint("Parent record found")
+                    ids = extract_ids(get_tree(parent_record))
+                    works_seen[wi] = ids
+        if ids:
+            apply_result(row, ids, result_columns)
+            vprint("Adding result dcc: %s lcc: %s to cache with key %s", ids[0], ids[1], (search_type, data))
+            searches_seen[(search_type, data)] = {"ddc": ids[0], "lcc": ids[1]}
         else:
-            vprint("Parent record not found, adding nil result to cache with key (%s, %s)" %(search_type, data))
+            vprint("Parent record not found, adding nil result to cache with key (%s, %s)", search_type, data)
             searches_seen[(search_type, data)] = {"ddc": None, "lcc": None}
-            return row, True
+        return row, True
 
 
 def find_field(field, columns):
@@ -326,10 +452,18 @@ def find_field(field, columns):
     return None
 
 
-def vprint(text):
-    """Print a line of text to screen only if -v flag was set"""
-    if verbose:
-        print(text)
+def vprint(message, *args):
+    """No-op stand-in, rebound to a printing version at startup on -v
+
+    Callers pass a format string plus arguments (logging-style) rather than a
+    pre-formatted string, so when verbose mode is off the hot paths pay for a
+    bare no-op call and never do any string formatting.
+    """
+    pass
+
+
+def verbose_print(message, *args):
+    print(message % args if args else message)
 
 
 if __name__ == '__main__':
@@ -354,8 +488,10 @@ For other formats:
     parser.add_argument("-n", "--non-exact", action="store_true", help="Allow non-exact matching of author and title")
     parser.add_argument("-e", "--except", dest="skip_columns", help="Supply a comma separated list of column names, \
                                                                 rows with data in any of these columns will be skipped")
-    parser.add_argument("-r", "--rate", action="store_true", help="Enable the alternate rate limiter")
-    parser.add_argument("-w", "--write", action="store_true", help="Enable writing of output during long sleeps")
+    parser.add_argument("-r", "--rate", action="store_true", help="Enable the alternate (more conservative) rate limit")
+    parser.add_argument("--workers", type=int, default=worker_count,
+                        help="Number of concurrent lookup threads (default %s)" % worker_count)
+    parser.add_argument("-w", "--write", action="store_true", help="Flush output to disk after every batch of rows")
     parser.add_argument("infile", help="Input CSV file")
     parser.add_argument("outfile", help="Output CSV file")
     args = parser.parse_args()
@@ -367,7 +503,7 @@ For other formats:
 
     if args.verbose:
         print("Enabling verbose mode")
-        verbose = True
+        vprint = verbose_print
 
     if args.non_exact:
         print("Enabling non-exact matches")
@@ -375,10 +511,7 @@ For other formats:
 
     if args.rate:
         print("Enabling alternate rate limiter")
-        rate_config = {"small_count": 10,  # How often to trigger small delay
-                       "small_sleep": 5,  # Length of small delay in seconds
-                       "large_count": 250,  # How often to trigger large delay
-                       "large_sleep": 300}  # Length of large delay in seconds
+        bucket = TokenBucket(alternate_rate_config["rate"], alternate_rate_config["burst"])
 
     print("Loading data from %s" % args.infile)
 
@@ -389,98 +522,147 @@ For other formats:
         skip_header = False
 
     if args.fields:
-        records_in = load_data(args.infile, fields="file", skipheader=False)  # -f flag implies there must be a header!
-        output_fields = records_in[0].keys()
+        records_in = load_data(args.infile)  # -f flag implies there must be a header!
+        header = next(records_in)
+        output_fields = header
+        # If the file already has ddc/lcc columns (a re-fed output from an earlier
+        # run), note their offsets so finished rows can skip the lookup entirely
+        header_lower = [column.lower() for column in header]
+        if "ddc" in header_lower and "lcc" in header_lower:
+            result_columns = (header_lower.index("ddc"), header_lower.index("lcc"))
+        elif "ddc" in header_lower or "lcc" in header_lower:
+            # One result column but not the other - results are attached as a
+            # (ddc, lcc) pair, so writing this would misalign every row against
+            # the header. Refuse rather than corrupt the output.
+            sys.exit("Fatal Error: input has a %s column but no %s column - "
+                     "add the missing column (or remove both) and re-run"
+                     % (("ddc", "lcc") if "ddc" in header_lower else ("lcc", "ddc")))
+        else:
+            result_columns = None
         # Lets see if we can find the fields automatically
-        file_fields = records_in[0].keys()
         potentials = {"ISBN": None,
                       "ISSN": None,
                       "Author": None,
                       "Title": None}
         for item in potentials:
-            potentials[item] = find_field(item, file_fields)
+            potentials[item] = find_field(item, header)
 
         print("Best match columns:")
-        for item, val in potentials.iteritems():
+        for item, val in potentials.items():
             print("%s: %s" % (item, val))
-        answer = raw_input("\nUse these columns? (Y/N): ")
+        answer = input("\nUse these columns? (Y/N): ")
         if answer in ["y", "Y"]:
-            columns = [potentials["ISBN"], potentials["ISSN"], potentials["Author"], potentials["Title"]]
+            # Work with column offsets from here on so row access inside the hot
+            # loop is a plain list index
+            columns = [header.index(potentials[item]) if potentials[item] else None
+                       for item in ["ISBN", "ISSN", "Author", "Title"]]
         else:
             sys.exit()
 
     elif args.columns:
-        records_in = load_data(args.infile, fields="none", skipheader=skip_header)
+        records_in = load_data(args.infile, skipheader=skip_header)
         output_fields = None
+        result_columns = None
         # Type the inputs
         columns = []
         for column in args.columns:
             try:
                 column = int(column)
-            except TypeError:
+            except (TypeError, ValueError):
                 column = None
             finally:
                 columns.append(column)
+        # Peek at the first row for the sanity checks below, then stitch it back
+        # onto the front of the stream
+        first_row = next(records_in, None)
+        if first_row is None:
+            sys.exit("Fatal Error: Input file contains no records!")
+        records_in = chain([first_row], records_in)
         # Check the highest input is not greater than the number of fields
-        if len(records_in[0]) < max(columns):
+        highest = max(column for column in columns if column is not None)
+        if len(first_row) < highest:
             sys.exit("Input column (%s) is greater than the number of fields in the CSV file (%s)"
-                     % (max(columns), len(records_in[0])))
+                     % (highest, len(first_row)))
         # Confirm with user that the selected columns are correct
         print("Selected columns would provide this data for the first entry:")
-        print("ISBN: %s" % records_in[0][columns[0]])
-        print("ISSN: %s" % records_in[0][columns[1]])
-        print("Author: %s" % records_in[0][columns[2]])
-        print("Title: %s" % records_in[0][columns[3]])
-        answer = raw_input("\nIs this correct? (Y/N): ")
+        print("ISBN: %s" % (first_row[columns[0]] if columns[0] is not None else ""))
+        print("ISSN: %s" % (first_row[columns[1]] if columns[1] is not None else ""))
+        print("Author: %s" % (first_row[columns[2]] if columns[2] is not None else ""))
+        print("Title: %s" % (first_row[columns[3]] if columns[3] is not None else ""))
+        answer = input("\nIs this correct? (Y/N): ")
         if answer in ["y", "Y"]:
             pass
         else:
             sys.exit()
     else:
         # Maybe could add a confirmation here in line with the other modes?
-        records_in = load_data(args.infile, fields="default", skipheader=skip_header)
+        records_in = load_data(args.infile, skipheader=skip_header)
         output_fields = default_fields
-        columns = default_fields
+        columns = [0, 1, 2, 3]
+        result_columns = None
 
     if args.skip_columns:
         skip_columns = args.skip_columns.split(",")
         print("Checking existence of fields for row skipping: %s" % skip_columns)
         skip_columns_lower = [data.lower() for data in skip_columns]
-        valid_skip_columns = [column for column in records_in[0].keys() if column.lower() in skip_columns_lower]
-        print("Fields found for row skipping: %s" % valid_skip_columns)
+        valid_skip_columns = tuple(index for index, column in enumerate(output_fields)
+                                   if column.lower() in skip_columns_lower)
+        print("Fields found for row skipping: %s" % [output_fields[index] for index in valid_skip_columns])
     else:
         valid_skip_columns = None
 
-    print("Loaded %s records" % len(records_in))
-    records_out = []
+    selector = make_query_selector(columns)
+    outfh, writer, header_fields = open_writer(args.outfile, output_fields)
+    row_width = len(header_fields) if header_fields else 0
     query_count = 0
-    query_since_sleep = False
-    for index, row in enumerate(records_in):
-        print("Processing record %s" % (index+1))
-        row_out, made_query = process_row(row, columns, valid_skip_columns)
-        records_out.append(row_out)
-
-        if made_query:
-            query_count += 1
-            query_since_sleep = True
-
-        # Rate limiter, small and large sleeps based on config
-        if query_count % rate_config["small_count"] == 0:
-            if query_since_sleep:
-                if query_count % rate_config["large_count"] == 0:
-                    if args.write:
-                        vprint("Writing progress so far to %s" % args.outfile)
-                        write_data(args.outfile, records_out, output_fields)
-                    m, s = divmod(rate_config["large_sleep"], 60)
-                    print("Rate limiter - %s queries - sleeping %s minutes %s seconds" % (rate_config["large_count"], m, s))
-                    time.sleep(rate_config["large_sleep"])
-                    query_since_sleep = False
+    index = 0
+    # Process rows in worker sized chunks - each chunk's queries run concurrently,
+    # paced individually by the token bucket inside oclc_search
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        while True:
+            chunk = list(islice(records_in, args.workers))
+            if not chunk:
+                break
+            # Dispatch only the first row for each distinct query in the chunk.
+            # Duplicates (multi-copy holdings share an ISBN) would otherwise
+            # fire the same request concurrently before the first result lands
+            # in searches_seen; held back until the parallel pass finishes,
+            # they resolve straight from the cache instead.
+            leaders = []
+            followers = []
+            chunk_queries = set()
+            for position, row in enumerate(chunk):
+                query = selector(row)
+                if query is None or query not in chunk_queries:
+                    chunk_queries.add(query)
+                    leaders.append(position)
                 else:
-                    print("Rate limiter - %s queries - sleeping %s seconds" % (rate_config["small_count"], rate_config["small_sleep"]))
-                    time.sleep(rate_config["small_sleep"])
-                    query_since_sleep = False
-
-    print("Finished processing, writing to file %s" % args.outfile)
-    write_data(args.outfile, records_out, output_fields)
+                    followers.append(position)
+            outputs = [None] * len(chunk)
+            for position, output in zip(leaders, executor.map(
+                    lambda p: process_row(chunk[p], selector, valid_skip_columns, result_columns), leaders)):
+                outputs[position] = output
+            for position in followers:
+                outputs[position] = process_row(chunk[position], selector, valid_skip_columns, result_columns)
+            for row_out, made_query in outputs:
+                index += 1
+                if index % 100 == 0:
+                    print("Processed %s records" % index)
+                if row_width and len(row_out) < row_width:
+                    # Keep the output rectangular - rows with no result still get
+                    # empty ddc/lcc cells under the header
+                    row_out = row_out + [""] * (row_width - len(row_out))
+                writer.writerow(row_out)
+
+                if made_query:
+                    query_count += 1
+
+            if args.write:
+                # Push the buffered rows out after each chunk rather than only at exit
+                outfh.flush()
+
+    print("Finished processing %s records (%s queries made), results written to %s"
+          % (index, query_count, args.outfile))
+    outfh.close()
 
     print("Done, goodbye!")